@@ -7,13 +7,23 @@ import pandas as pd
 import geopandas as gpd
 from pathlib import Path
 import requests
-from shapely.prepared import prep
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+import shapely
 import matplotlib.pyplot as plt
 import re
 import sys
+import os
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Set backend to 'Agg' to prevent plot windows from opening
 plt.switch_backend('Agg')
+# Single histogram figure, cleared and reused for every vessel
+fig, ax = plt.subplots(figsize=(8, 5))
 
 # CONFIGURATION
 base_path = Path.cwd()
@@ -22,13 +32,70 @@ output_folder = base_path / "data" / "south_fork"
 gdb_path = output_folder / "south_fork_vessel_ais.gdb"
 merged_layer_name = "south_fork_vessel_merged"
 
+# Projected CRS (UTM 18N) used for the land mask buffer and point-in-polygon tests
+utm_epsg = 32618
+
 rest_url = "https://services7.arcgis.com/G5Ma95RzqJRPKsWL/ArcGIS/rest/services/BOEM_Renewable_States/FeatureServer/0/query?where=1=1&outFields=*&f=geojson"
 
 output_folder.mkdir(parents=True, exist_ok=True)
 hist_folder = output_folder / "vessel_histograms"
 hist_folder.mkdir(parents=True, exist_ok=True)
+parquet_folder = output_folder / "vessel_parquet"
+parquet_folder.mkdir(parents=True, exist_ok=True)
+
+# Columns used by the pipeline and their compact Parquet types
+ais_columns = ['MMSI', 'BASEDATETIME', 'SOG', 'LAT', 'LON', 'STATUS']
+ais_arrow_types = {
+    'MMSI': pa.uint32(),
+    'BASEDATETIME': pa.timestamp('s'),
+    'SOG': pa.float32(),
+    'LAT': pa.float32(),
+    'LON': pa.float32(),
+    'STATUS': pa.int8()
+}
+# Matching pandas dtypes (STATUS is nullable since AIS status is often missing)
+ais_dtypes = {'MMSI': 'uint32', 'SOG': 'float32', 'LAT': 'float32', 'LON': 'float32', 'STATUS': 'Int8'}
+
+def ingest_to_parquet():
+    # One-time conversion of the raw vessel CSVs to Parquet (skipped if the Parquet is up to date)
+    csv_files = list(csv_folder.glob("*.csv"))
+    print(f"Converting {len(csv_files)} vessel CSVs to Parquet...")
+
+    # Remove Parquet files whose source CSV no longer exists
+    csv_stems = {csv_file.stem for csv_file in csv_files}
+    for parquet_file in parquet_folder.glob("*.parquet"):
+        if parquet_file.stem not in csv_stems:
+            parquet_file.unlink()
+
+    for csv_file in csv_files:
+        parquet_file = parquet_folder / f"{csv_file.stem}.parquet"
+        if parquet_file.exists() and parquet_file.stat().st_mtime >= csv_file.stat().st_mtime:
+            continue
+        try:
+            # Set column types explicitly (matched on the raw header names) rather than letting
+            # pyarrow infer them from the first block, e.g. a STATUS column that starts out blank
+            with open(csv_file, encoding='utf-8-sig') as f:
+                header = [col.strip().strip('"') for col in f.readline().split(',')]
+            column_types = {col: ais_arrow_types[col.upper()] for col in header if col.upper() in ais_arrow_types}
+            table = pv.read_csv(csv_file, convert_options=pv.ConvertOptions(column_types=column_types))
+            table = table.rename_columns([c.upper() for c in table.column_names])
+            pq.write_table(table, parquet_file, compression='zstd')
+        except Exception as e:
+            # Don't leave an out of date Parquet behind for this vessel
+            parquet_file.unlink(missing_ok=True)
+            print(f"\nError processing {csv_file.stem}: {e}")
+
+def get_land_mask(url, buffer_meters=-500, refresh=False, max_age_days=30):
+    # Buffered land mask is cached as GeoParquet (in UTM), keyed on the source URL and buffer
+    cache_key = hashlib.md5(f"{url}|{buffer_meters}".encode()).hexdigest()[:12]
+    cache_path = output_folder / f"land_mask_{cache_key}.parquet"
+    if not refresh and cache_path.exists() and (time.time() - cache_path.stat().st_mtime) < max_age_days * 86400:
+        print(f"Loading cached land mask from {cache_path.name}...")
+        try:
+            return gpd.read_parquet(cache_path).geometry.iloc[0]
+        except Exception as e:
+            print(f"Cached land mask could not be read ({e}), fetching again...")
 
-def get_land_mask(url, buffer_meters=-500):
     print("Fetching land boundaries from REST API...")
     headers = {'User-Agent': 'Mozilla/5.0'}
     try:
@@ -36,95 +103,203 @@ def get_land_mask(url, buffer_meters=-500):
         response.raise_for_status()
         data = response.json()
         states = gpd.GeoDataFrame.from_features(data["features"], crs="EPSG:4326")
-        states_m = states.to_crs(epsg=32618)
+        states_m = states.to_crs(epsg=utm_epsg)
         print(f"Applying {buffer_meters}m buffer...")
         states_m['geometry'] = states_m.buffer(buffer_meters)
-        return states_m.to_crs(epsg=4326).union_all()
+        # Mask is kept in UTM; points are projected once per vessel for the land test
+        land_mask = states_m.union_all()
     except Exception as e:
         print(f"CRITICAL ERROR fetching land data: {e}")
         return None
 
-def process_ais_to_gdb():
-    land_geometry_raw = get_land_mask(rest_url)
+    # Failing to cache the mask is not fatal, the next run just fetches it again
+    try:
+        gpd.GeoDataFrame(geometry=[land_mask], crs=f"EPSG:{utm_epsg}").to_parquet(cache_path)
+    except Exception as e:
+        print(f"Warning: land mask could not be cached: {e}")
+    return land_mask
+
+# Vessel files with more rows than this are cleaned in the main process after the pool,
+# using Dask-GeoPandas for the land test (so Dask has all cores to itself)
+dask_min_points = 500_000
+
+# Land mask STRtree (and polygons for the Dask path), built once in each process
+land_tree = None
+land_gdf = None
+
+def _init_worker(land_wkb):
+    global land_tree, land_gdf
+    # Split the land mask into its individual polygons and index them in an STRtree
+    land_polys = shapely.get_parts(shapely.from_wkb(land_wkb))
+    land_tree = shapely.STRtree(land_polys)
+    land_gdf = gpd.GeoDataFrame(geometry=land_polys, crs=f"EPSG:{utm_epsg}")
+
+def get_mmsi_label(parquet_file):
+    mmsi_match = re.search(r'\d{9}', parquet_file.stem)
+    return mmsi_match.group(0) if mmsi_match else parquet_file.stem
+
+def process_one(parquet_file, use_dask=False):
+    # Clean a single vessel file; returns (mmsi_label, status, stats, gdf)
+    mmsi_label = get_mmsi_label(parquet_file)
+
+    try:
+        df = pd.read_parquet(parquet_file, columns=ais_columns)
+        # Remove rows where SOG, lat, long are NA
+        df = df.dropna(subset=['SOG', 'LAT', 'LON'])
+        # Downcast to compact dtypes (nullable STATUS is read back from Parquet as float64)
+        df = df.astype(ais_dtypes)
+        # Remove rows where SOG is greater than 40
+        df = df[df['SOG'] <= 40]
+
+        if df.empty:
+            return mmsi_label, "Skipped (Empty)", None, None
+
+        gdf = gpd.GeoDataFrame(df, geometry=shapely.points(df['LON'].to_numpy(), df['LAT'].to_numpy()), crs="EPSG:4326")
+        # Project once to UTM and keep the coordinates for the trackline distance calculation
+        points_utm = gdf.geometry.to_crs(epsg=utm_epsg).values
+        gdf['X_UTM'] = shapely.get_x(points_utm).astype('float32')
+        gdf['Y_UTM'] = shapely.get_y(points_utm).astype('float32')
+        # Remove points on land
+        on_land_idx = None
+        if use_dask:
+            try:
+                import dask_geopandas
+            except ImportError:
+                # Dask-GeoPandas is optional; use the STRtree path below instead
+                print(f"{mmsi_label}: dask_geopandas not installed, using single-core land test")
+            else:
+                # Very large vessels: split the points into partitions and join against land in parallel
+                points_gdf = gpd.GeoDataFrame(geometry=points_utm, crs=f"EPSG:{utm_epsg}")
+                dgdf = dask_geopandas.from_geopandas(points_gdf, npartitions=os.cpu_count())
+                on_land_idx = dgdf.sjoin(land_gdf, predicate='within').index.compute().to_numpy()
+        if on_land_idx is None:
+            # Returns pairs of [point index, polygon index]
+            on_land_idx = land_tree.query(points_utm, predicate='within')[0]
+        keep_mask = np.ones(len(gdf), dtype=bool)
+        keep_mask[on_land_idx] = False
+        # Boolean indexing already returns a new frame (and sort_values below makes another)
+        gdf = gdf.loc[keep_mask]
+
+        if gdf.empty:
+            return mmsi_label, "Skipped (Land)", None, None
+
+        # Time Gaps & Stats
+        # Sort geodataframe by MMSI and time
+        gdf = gdf.sort_values(['MMSI', 'BASEDATETIME'])
+        # Create a column of the time difference between consecutive points (hours, from int64 nanoseconds)
+        t = gdf['BASEDATETIME'].to_numpy().astype('datetime64[ns]')
+        t_ns = t.view('i8')
+        mmsi = gdf['MMSI'].to_numpy()
+        time_diff = np.empty(len(gdf), dtype=np.float32)
+        time_diff[0] = np.nan
+        time_diff[1:] = (t_ns[1:] - t_ns[:-1]) * (1.0 / 3.6e12)
+        # First point of each vessel has no previous point
+        time_diff[1:][mmsi[1:] != mmsi[:-1]] = np.nan
+        # Missing timestamps view as INT64_MIN, so gaps touching them are unknown
+        missing_time = np.isnat(t)
+        time_diff[1:][missing_time[1:] | missing_time[:-1]] = np.nan
+        gdf['TIME_DIFF_HOURS'] = time_diff
+
+        total_pts = len(gdf)
+        # Sum time gaps of greater than 1 hr
+        gaps_gt_1 = (gdf['TIME_DIFF_HOURS'] > 1).sum()
+        # Sum time gaps of greater than 8 hrs
+        gaps_gt_8 = (gdf['TIME_DIFF_HOURS'] > 8).sum()
+        pct_gt_1 = (gaps_gt_1 / total_pts) * 100
+        max_hr = gdf['TIME_DIFF_HOURS'].max()
+        avg_min = gdf['TIME_DIFF_HOURS'].mean() * 60
+        med_min = gdf['TIME_DIFF_HOURS'].median() * 60
+
+        # Create vessel stats
+        stats = {
+            'MMSI': mmsi_label,
+            'total_points': total_pts,
+            'gaps_gt_1hr': gaps_gt_1,
+            'gaps_gt_8hr': gaps_gt_8,
+            'percent_gt_1hr': round(pct_gt_1, 2),
+            'max_gap_hours': round(max_hr, 2),
+            'avg_gap_minutes': round(avg_min, 2),
+            'median_gap_minutes': round(med_min, 2)
+        }
+
+        # Create histograms of individual vessel time difference between points (90th Percentile in Minutes)
+        plot_data_mins = gdf['TIME_DIFF_HOURS'].dropna() * 60
+        if not plot_data_mins.empty:
+            p90_mins = plot_data_mins.quantile(0.90)
+            upper_limit = max(p90_mins, 1.0)
+
+            filtered_plot = plot_data_mins[plot_data_mins <= upper_limit]
+
+            counts, edges = np.histogram(filtered_plot.to_numpy(), bins=40)
+
+            ax.cla()
+            ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge', color='teal', edgecolor='white')
+            ax.set_title(f"MMSI: {mmsi_label}\n(90% Gaps | Max: {upper_limit:.2f} mins)")
+            ax.set_xlabel("Time Difference (Minutes)")
+            ax.set_ylabel("Frequency")
+            ax.grid(axis='y', alpha=0.3)
+            fig.savefig(hist_folder / f"{mmsi_label}_hist.png", dpi=80)
+
+        return mmsi_label, "Done.", stats, gdf
+
+    except Exception as e:
+        return mmsi_label, f"Error: {e}", None, None
+
+def process_ais_to_gdb(refresh_land_mask=False):
+    land_geometry_raw = get_land_mask(rest_url, refresh=refresh_land_mask)
     if land_geometry_raw is None:
         print("\n[!] Execution stopped: Land mask could not be created.")
         sys.exit()
 
-    land_geometry = prep(land_geometry_raw)
-    csv_files = list(csv_folder.glob("*.csv"))
-    print(f"Found {len(csv_files)} vessels to process.")
+    parquet_files = list(parquet_folder.glob("*.parquet"))
+    print(f"Found {len(parquet_files)} vessels to process.")
     
-    first_vessel = True 
     all_vessel_stats = {} 
+    cleaned = []
 
-    for csv_file in csv_files:
-        mmsi_match = re.search(r'\d{9}', csv_file.stem)
-        mmsi_label = mmsi_match.group(0) if mmsi_match else csv_file.stem
-        
-        print(f"Starting: {mmsi_label}...", end=" ", flush=True)
+    # Very large vessels are kept out of the pool and use Dask in the main process instead
+    pool_files, dask_files = [], []
+    for f in parquet_files:
         try:
-            df = pd.read_csv(csv_file, parse_dates=['BaseDateTime'])
-            df.columns = df.columns.str.upper()
-            # Remove rows where SOG, lat, long are NA
-            df = df.dropna(subset=['SOG', 'LAT', 'LON'])
-            # Remove rows where SOG is greater than 40
-            df = df[df['SOG'] <= 40]
-            
-            if df.empty: 
-                print("Skipped (Empty)")
-                continue
+            num_rows = pq.ParquetFile(f).metadata.num_rows
+        except Exception:
+            num_rows = 0  # Unreadable file: let process_one report the error
+        (dask_files if num_rows > dask_min_points else pool_files).append(f)
 
-            gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.LON, df.LAT), crs="EPSG:4326")
-            gdf = gdf[~gdf.geometry.apply(lambda x: land_geometry.contains(x))].copy()
+    # Clean vessels in parallel; each worker rebuilds the land mask from WKB once
+    land_wkb = shapely.to_wkb(land_geometry_raw)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker, initargs=(land_wkb,)) as ex:
+        futures = {ex.submit(process_one, f): f for f in pool_files}
 
-            if gdf.empty:
-                print("Skipped (Land)")
+        # Report each vessel as soon as it finishes (exports below still follow input order)
+        pool_results = {}
+        for future in as_completed(futures):
+            parquet_file = futures[future]
+            # A crashed worker (e.g. out of memory) only loses that vessel
+            try:
+                pool_results[parquet_file] = future.result()
+            except Exception as e:
+                print(f"\nError processing {get_mmsi_label(parquet_file)}: {e}")
                 continue
+            mmsi_label, status, _, _ = pool_results[parquet_file]
+            print(f"{mmsi_label}: {status}")
+        results = [pool_results[f] for f in pool_files if f in pool_results]
+        pool_results.clear()
 
-            # Time Gaps & Stats
-            # Sort geodataframe by MMSI and time
-            gdf = gdf.sort_values(['MMSI', 'BASEDATETIME'])
-            # Create a column of the time difference between consecutive points 
-            gdf['TIME_DIFF_HOURS'] = gdf.groupby('MMSI')['BASEDATETIME'].diff().dt.total_seconds() / 3600
-            
-            total_pts = len(gdf)
-            # Sum time gaps of greater than 1 hr
-            gaps_gt_1 = (gdf['TIME_DIFF_HOURS'] > 1).sum()
-            # Sum time gaps of greater than 8 hrs
-            gaps_gt_8 = (gdf['TIME_DIFF_HOURS'] > 8).sum()
-            pct_gt_1 = (gaps_gt_1 / total_pts) * 100
-            max_hr = gdf['TIME_DIFF_HOURS'].max()
-            avg_min = gdf['TIME_DIFF_HOURS'].mean() * 60
-            med_min = gdf['TIME_DIFF_HOURS'].median() * 60
-            
-            # Create vessel stats
-            all_vessel_stats[mmsi_label] = {
-                'MMSI': mmsi_label,
-                'total_points': total_pts,
-                'gaps_gt_1hr': gaps_gt_1,
-                'gaps_gt_8hr': gaps_gt_8,
-                'percent_gt_1hr': round(pct_gt_1, 2),
-                'max_gap_hours': round(max_hr, 2),
-                'avg_gap_minutes': round(avg_min, 2),
-                'median_gap_minutes': round(med_min, 2)
-            }
-
-            # Create histograms of individual vessel time difference between points (90th Percentile in Minutes)
-            plot_data_mins = gdf['TIME_DIFF_HOURS'].dropna() * 60
-            if not plot_data_mins.empty:
-                p90_mins = plot_data_mins.quantile(0.90)
-                upper_limit = max(p90_mins, 1.0)
-                
-                filtered_plot = plot_data_mins[plot_data_mins <= upper_limit]
-
-                plt.figure(figsize=(8, 5))
-                plt.hist(filtered_plot, bins=40, color='teal', edgecolor='white')
-                plt.title(f"MMSI: {mmsi_label}\n(90% Gaps | Max: {upper_limit:.2f} mins)")
-                plt.xlabel("Time Difference (Minutes)")
-                plt.ylabel("Frequency")
-                plt.grid(axis='y', alpha=0.3)
-                plt.savefig(hist_folder / f"{mmsi_label}_hist.png")
-                plt.close()
+    if dask_files:
+        _init_worker(land_wkb)
+        for parquet_file in dask_files:
+            results.append(process_one(parquet_file, use_dask=True))
+            print(f"{results[-1][0]}: {results[-1][1]}")
+
+    # GDB writes are not safe to parallelize, so export in the main process
+    print("Exporting vessel layers...")
+    for mmsi_label, status, stats, gdf in results:
+        if gdf is None:
+            continue
+
+        try:
+            all_vessel_stats[mmsi_label] = stats
 
             # Export to GDB
             layer_name = f"V{mmsi_label}"
@@ -132,22 +307,32 @@ def process_ais_to_gdb():
             # Individual Layer: Always 'w' to overwrite just this vessel's layer
             gdf.to_file(str(gdb_path), layer=layer_name, driver="OpenFileGDB", engine="pyogrio", mode='w')
 
-            # Merged Layer: 'w' for the very first vessel, 'a' for all others
-            if first_vessel:
-                gdf.to_file(str(gdb_path), layer=merged_layer_name, driver="OpenFileGDB", engine="pyogrio", mode='w')
-                first_vessel = False
-            else:
-                gdf.to_file(str(gdb_path), layer=merged_layer_name, driver="OpenFileGDB", engine="pyogrio", mode='a')
-            
-            print("Done.")
+            # Merged Layer: collected here and written once after all vessels are processed
+            cleaned.append(gdf)
 
         except Exception as e:
             print(f"\nError processing {mmsi_label}: {e}")
 
+    # Per-vessel results are no longer needed (cleaned keeps the frames for the merged layer)
+    results.clear()
+
+    # Merged Layer: single write instead of reopening the GDB to append each vessel
+    if cleaned:
+        print(f"Writing merged layer {merged_layer_name}...")
+        # Written sorted by MMSI and time so downstream pipelines can skip re-sorting:
+        # each vessel frame is already sorted, so only the vessel order needs fixing
+        cleaned.sort(key=lambda g: g['MMSI'].iat[0])
+        merged_gdf = pd.concat(cleaned, ignore_index=True)
+        # Drop the per-vessel frames now that they are in the merged frame
+        cleaned.clear()
+        merged_gdf.to_file(str(gdb_path), layer=merged_layer_name, driver="OpenFileGDB", engine="pyogrio", mode='w')
+
     return all_vessel_stats
 
 if __name__ == "__main__":
-    vessel_stats = process_ais_to_gdb()
+    ingest_to_parquet()
+    # Pass --refresh-land-mask to re-download the land boundaries instead of using the cache
+    vessel_stats = process_ais_to_gdb(refresh_land_mask="--refresh-land-mask" in sys.argv)
     
     if vessel_stats:
         summary_df = pd.DataFrame.from_dict(vessel_stats, orient='index')
@@ -7,7 +7,8 @@
 import geopandas as gpd
 from pathlib import Path
 import h3
-from shapely.geometry import Polygon
+import numpy as np
+import shapely
 
 # CONFIGURATION
 # Set folder paths
@@ -18,32 +19,38 @@ merged_layer_name = "south_fork_vessel_merged"
 
 def create_detailed_hexbins(gdb_path, input_layer=merged_layer_name, resolution=8):
     print(f"Loading merged data from {input_layer}...")
-    gdf = gpd.read_file(str(gdb_path), layer=input_layer, engine="pyogrio")
+    # Only the attributes needed for aggregation (Arrow read avoids an extra copy)
+    gdf = gpd.read_file(str(gdb_path), layer=input_layer, engine="pyogrio",
+                        columns=['MMSI', 'TIME_DIFF_HOURS'], use_arrow=True)
     
     if gdf.empty:
         return
 
     print(f"Generating H3 IDs at Resolution {resolution}...")
-    # H3 v4.x syntax
-    gdf['h3_id'] = gdf.apply(lambda row: h3.latlng_to_cell(row.geometry.y, row.geometry.x, resolution), axis=1)
+    # H3 v4.x syntax (iterate over coordinate arrays rather than DataFrame rows)
+    lats = gdf.geometry.y.to_numpy()
+    lons = gdf.geometry.x.to_numpy()
+    gdf['h3_id'] = [h3.latlng_to_cell(lat, lon, resolution) for lat, lon in zip(lats, lons)]
 
     # Group by BOTH Hexagon and Vessel.
     # This keeps each vessel's time separate within the same hex.
     print("Aggregating by Hexagon + Vessel...")
-    hex_summary = gdf.groupby(['h3_id', 'MMSI']).agg({
-        'TIME_DIFF_HOURS': 'sum'
-    }).reset_index()
+    hex_summary = gdf.groupby(['h3_id', 'MMSI'])['TIME_DIFF_HOURS'].sum().reset_index()
 
     # Rename columns for clarity
     hex_summary = hex_summary.rename(columns={'TIME_DIFF_HOURS': 'VESSEL_HOURS'})
 
     # Create Polygon Geometries
-    def h3_to_polygon(h3_id):
-        boundary = h3.cell_to_boundary(h3_id)
-        return Polygon([(lon, lat) for lat, lon in boundary])
-
+    # Only build each hexagon once, then map back onto every vessel row in that hex
     print("Generating geometries...")
-    hex_summary['geometry'] = hex_summary['h3_id'].apply(h3_to_polygon)
+    unique_ids = hex_summary['h3_id'].unique()
+    boundaries = [h3.cell_to_boundary(h3_id) for h3_id in unique_ids]
+    # Flatten boundaries to (lon, lat) with a ring index (pentagons have 5 vertices, so not all the same size)
+    coords = np.array([(lon, lat) for boundary in boundaries for lat, lon in boundary])
+    ring_idx = np.repeat(np.arange(len(unique_ids)), [len(boundary) for boundary in boundaries])
+    polys = shapely.polygons(shapely.linearrings(coords, indices=ring_idx))
+    poly_map = dict(zip(unique_ids, polys))
+    hex_summary['geometry'] = hex_summary['h3_id'].map(poly_map)
     
     hex_gdf = gpd.GeoDataFrame(hex_summary, geometry='geometry', crs="EPSG:4326")
     
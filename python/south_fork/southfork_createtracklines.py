@@ -5,8 +5,11 @@
 
 import pandas as pd
 import geopandas as gpd
+import numpy as np
 from pathlib import Path
-from shapely.geometry import Point, LineString
+import shapely
+import pyogrio
+from numba import njit
 
 # CONFIGURATION
 # Set folder paths
@@ -39,7 +42,7 @@ ports_df = pd.DataFrame(ports_list)
 # Convert to a GeoDataFrame
 ports_gdf = gpd.GeoDataFrame(
     ports_df, 
-    geometry=gpd.points_from_xy(ports_df.lon, ports_df.lat),
+    geometry=shapely.points(ports_df['lon'].to_numpy(), ports_df['lat'].to_numpy()),
     crs="EPSG:4326"  # Standard WGS84 coordinate system
 )
 
@@ -47,89 +50,162 @@ ports_gdf = gpd.GeoDataFrame(
 ports_gdf.to_file(str(gdb_path), layer=ports_layer, driver="OpenFileGDB", engine="pyogrio")
 print(f"---Port point feature class created at {gdb_path}---")
 
+# Trip ID kernel: single pass over points sorted by MMSI and time
+# New trip if: Left Port OR Gap between points > 8hrs OR Status changed from Anchor/Moored
+# (as before, the transition tests compare against the previous row even across vessels)
+@njit(cache=True)
+def build_trip_ids(mmsi, in_port, parked, time_diff):
+    trip_id = np.zeros(len(mmsi), dtype=np.int64)
+    current = 0
+    for i in range(len(mmsi)):
+        if i == 0 or mmsi[i] != mmsi[i - 1]:
+            current = 0
+        if i > 0:
+            left_port = in_port[i - 1] and not in_port[i]
+            left_parked = parked[i - 1] and not parked[i]
+            if left_port or time_diff[i] > 8 or left_parked:
+                current += 1
+        trip_id[i] = current
+    return trip_id
+
+# Check that points are ordered by MMSI, then by time within each vessel
+def is_sorted_by_vessel_time(gdf):
+    mmsi = gdf['MMSI'].to_numpy()
+    t = gdf['BASEDATETIME'].to_numpy()
+    same_vessel = mmsi[1:] == mmsi[:-1]
+    return gdf['MMSI'].is_monotonic_increasing and (t[1:][same_vessel] >= t[:-1][same_vessel]).all()
+
 # Function to create tracklines
 def run_trackline_pipeline():
     # Load the merged point layer
     print(f"Reading points from {input_layer}...")
-    gdf = gpd.read_file(str(gdb_path), layer=input_layer, engine="pyogrio")
+    # Only the attributes needed for trip building (Arrow read avoids an extra copy)
+    # X_UTM/Y_UTM are only present in merged layers written by the current cleaning step
+    layer_fields = set(pyogrio.read_info(str(gdb_path), layer=input_layer)['fields'])
+    has_utm = {'X_UTM', 'Y_UTM'}.issubset(layer_fields)
+    read_columns = ['MMSI', 'BASEDATETIME', 'SOG', 'STATUS'] + (['X_UTM', 'Y_UTM'] if has_utm else [])
+    gdf = gpd.read_file(str(gdb_path), layer=input_layer, engine="pyogrio",
+                        columns=read_columns, use_arrow=True)
     
     # Ensure column names are standardized
     gdf.columns = gdf.columns.str.upper()
     if "GEOMETRY" in gdf.columns:
         gdf = gdf.set_geometry("GEOMETRY")
     gdf['BASEDATETIME'] = pd.to_datetime(gdf['BASEDATETIME'])
-    gdf = gdf.sort_values(['MMSI', 'BASEDATETIME'])
+    # Merged layer is written sorted by MMSI and time; only re-sort if that does not hold
+    if not is_sorted_by_vessel_time(gdf):
+        gdf = gdf.sort_values(['MMSI', 'BASEDATETIME'])
+
+    # Data is sorted by MMSI and time, so vessels are contiguous runs of rows
+    mmsi = gdf['MMSI'].to_numpy()
+    t = gdf['BASEDATETIME'].to_numpy().astype('datetime64[ns]')
+    t_ns = t.view('i8')
 
     # Build Port Mask for Geofencing
     print("Creating port geofences...")
-    port_pts = [Point(lon, lat) for lon, lat in ports_data.values()]
+    port_coords = np.asarray(list(ports_data.values()))
+    port_pts = shapely.points(port_coords[:, 0], port_coords[:, 1])
     ports_gdf = gpd.GeoDataFrame({'port_name': list(ports_data.keys())}, geometry=port_pts, crs="EPSG:4326")
     ports_mask_m = ports_gdf.to_crs(epsg=32618)
     ports_mask_m['geometry'] = ports_mask_m.buffer(1000) # 1km buffer radius around port points
-    port_mask_geom = ports_mask_m.to_crs(epsg=4326).union_all()
+    ports_tree = shapely.STRtree(ports_mask_m.to_crs(epsg=4326).geometry.values)
 
     # Trip Segmentation/Creation & Flagging Logic
     print("Processing behavioral flags and trip segments...")
     
     # Port Status
     # Create column for whether points are within the port geofence
-    gdf['IN_PORT'] = gdf.geometry.within(port_mask_geom)
+    # Query all points against the port buffers (returns pairs of [point index, port index])
+    in_port_idx = ports_tree.query(gdf.geometry.values, predicate='within')[0]
+    in_port = np.zeros(len(gdf), dtype=bool)
+    in_port[in_port_idx] = True
+    gdf['IN_PORT'] = in_port
     
     # Create stationary flag (SOG < 1 for > 1 hour)
-    gdf['TIME_DIFF'] = gdf.groupby('MMSI')['BASEDATETIME'].diff().dt.total_seconds() / 3600
-    gdf['IS_LOW_SPEED'] = gdf['SOG'] < 1.0
-    gdf['state_group'] = (gdf['IS_LOW_SPEED'] != gdf['IS_LOW_SPEED'].shift()).cumsum()
-    state_durations = gdf.groupby(['MMSI', 'state_group'])['TIME_DIFF'].transform('sum')
-    gdf['FLAG_STATIONARY'] = ((gdf['IS_LOW_SPEED'] == True) & (state_durations >= 1.0)).astype(int)
+    new_vessel = np.ones(len(gdf), dtype=bool)
+    new_vessel[1:] = mmsi[1:] != mmsi[:-1]
+    # Time difference (hours) from the previous point of the same vessel, straight from int64 nanoseconds
+    time_diff = np.empty(len(gdf), dtype=np.float32)
+    time_diff[1:] = (t_ns[1:] - t_ns[:-1]) * (1.0 / 3.6e12)
+    time_diff[new_vessel] = np.nan
+    # Missing timestamps view as INT64_MIN, so gaps touching them are unknown
+    missing_time = np.isnat(t)
+    time_diff[1:][missing_time[1:] | missing_time[:-1]] = np.nan
+    gdf['TIME_DIFF'] = time_diff
+
+    # Low speed segments: a new segment starts at each new vessel or change in low speed state
+    is_low_speed = (gdf['SOG'] < 1.0).to_numpy()
+    gdf['IS_LOW_SPEED'] = is_low_speed
+    seg_start = new_vessel.copy()
+    seg_start[1:] |= is_low_speed[1:] != is_low_speed[:-1]
+    starts = np.flatnonzero(seg_start)
+    seg_durations = np.add.reduceat(np.nan_to_num(time_diff), starts)
+    state_durations = np.repeat(seg_durations, np.diff(np.append(starts, len(gdf))))
+    gdf['FLAG_STATIONARY'] = (is_low_speed & (state_durations >= 1.0)).astype(int)
 
     # Status Transitions (Status 1=Anchor, 5=Moored)
     # Create a new trip when status changes from 1 or 5 to another status
     parked_statuses = [1, 5]
-    gdf['STATUS_CHANGED'] = (
-        (~gdf['STATUS'].isin(parked_statuses)) & 
-        (gdf['STATUS'].shift(1).isin(parked_statuses))
-    )
+    parked = gdf['STATUS'].isin(parked_statuses).to_numpy()
 
     # Trip ID Generation
-    # New trip if: Left Port OR Gap between points > 8hrs OR Status changed from Anchor/Moored
-    gdf['TRIP_START'] = (
-        ((gdf['IN_PORT'] == False) & (gdf['IN_PORT'].shift(1) == True)) | 
-        (gdf['TIME_DIFF'] > 8) |
-        (gdf['STATUS_CHANGED'] == True)
-    )
-    gdf['TRIP_ID'] = gdf.groupby('MMSI')['TRIP_START'].cumsum()
+    gdf['TRIP_ID'] = build_trip_ids(mmsi, in_port, parked, time_diff)
 
     # Connect Points to Lines
     print("Creating tracklines...")
-    # Group and create lines
-    lines_series = gdf.groupby(['MMSI', 'TRIP_ID'])['GEOMETRY'].apply(
-        lambda x: LineString(x.tolist()) if len(x) >= 2 else None
-    ).dropna()
-    
-    # Explicitly set the geometry column name in the constructor
+    # Trips are contiguous runs of rows (sorted by MMSI and time, TRIP_ID increases within each vessel)
+    trip_id = gdf['TRIP_ID'].to_numpy()
+    new_trip = new_vessel.copy()
+    new_trip[1:] |= trip_id[1:] != trip_id[:-1]
+    trip_starts = np.flatnonzero(new_trip)
+    trip_sizes = np.diff(np.append(trip_starts, len(gdf)))
+
+    # Only trips with at least 2 points can form a line
+    keep_trips = trip_sizes >= 2
+    keep_points = np.repeat(keep_trips, trip_sizes)
+    line_idx = np.repeat(np.cumsum(keep_trips) - 1, trip_sizes)[keep_points]
+
+    # Build all lines in a single call from the point coordinates
+    xy = shapely.get_coordinates(gdf.geometry.values)
+    lines = shapely.linestrings(xy[keep_points], indices=line_idx)
+    # Same lines from the UTM 18N coordinates stored by the cleaning step (for distance)
+    if has_utm:
+        xy_utm = gdf[['X_UTM', 'Y_UTM']].to_numpy(dtype='float64')
+        lines_utm = shapely.linestrings(xy_utm[keep_points], indices=line_idx)
+
+    # Lowercase geometry name for GDB standard compatibility
     lines_gdf = gpd.GeoDataFrame(
-        lines_series, 
-        geometry='GEOMETRY', 
+        {'MMSI': mmsi[trip_starts[keep_trips]], 'TRIP_ID': trip_id[trip_starts[keep_trips]]},
+        geometry=lines,
         crs="EPSG:4326"
-    ).reset_index()
-
-    # Rename to lowercase for GDB standard compatibility
-    lines_gdf = lines_gdf.rename_geometry('geometry')
+    )
 
     # Calculate Trip Metrics (Duration & Distance)
     print("Calculating trip duration and distance...")
     
     # Metadata and Duration
-    metrics = gdf.groupby(['MMSI', 'TRIP_ID']).agg({
-        'BASEDATETIME': ['min', 'max'],
-        'FLAG_STATIONARY': 'max' # Did this trip contain a stationary period?
-    }).reset_index()
-    metrics.columns = ['MMSI', 'TRIP_ID', 'START_TIME', 'END_TIME', 'HAD_STATIONARY']
+    # Per-trip min/max time over the int64 view, skipping missing timestamps (NaT is INT64_MIN,
+    # so it already drops out of the max; for the min it is swapped for INT64_MAX)
+    nat_i8 = np.iinfo(np.int64).min
+    start_ns = np.minimum.reduceat(np.where(missing_time, np.iinfo(np.int64).max, t_ns), trip_starts)
+    start_ns[start_ns == np.iinfo(np.int64).max] = nat_i8  # Trips with no valid timestamps
+    end_ns = np.maximum.reduceat(t_ns, trip_starts)
+    metrics = pd.DataFrame({
+        'MMSI': mmsi[trip_starts],
+        'TRIP_ID': trip_id[trip_starts],
+        'START_TIME': start_ns.view('datetime64[ns]'),
+        'END_TIME': end_ns.view('datetime64[ns]'),
+        # Did this trip contain a stationary period?
+        'HAD_STATIONARY': np.maximum.reduceat(gdf['FLAG_STATIONARY'].to_numpy(), trip_starts)
+    })
     metrics['DURATION_HRS'] = (metrics['END_TIME'] - metrics['START_TIME']).dt.total_seconds() / 3600
     
-    # Project to UTM 18N for distance (Nautical Miles)
-    lines_utm = lines_gdf.to_crs(epsg=32618)
-    lines_gdf['DIST_NM'] = (lines_utm.geometry.length * 0.000539957)
+    # Distance from the UTM 18N lines (Nautical Miles)
+    if has_utm:
+        lines_gdf['DIST_NM'] = (shapely.length(lines_utm) * 0.000539957)
+    else:
+        # Older merged layers without stored UTM coordinates: project the lines instead
+        lines_gdf['DIST_NM'] = (lines_gdf.to_crs(epsg=32618).length * 0.000539957)
 
     # Merge everything
     final_lines = lines_gdf.merge(metrics, on=['MMSI', 'TRIP_ID'])